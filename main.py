@@ -1,21 +1,81 @@
+import concurrent.futures
+import ctypes
+import dataclasses
+import functools
 import math
 import os.path
 import typing
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
-import bezier
 import numpy as np
+import PIL.Image
 import pyglet
-import sympy
-import webcolors
 
 SIZE = 250
 RENDER_FPS = 50
+# each transition snaps to this many steps, more than that isn't visible anyway
+TRANSITION_STEPS = 256
+# inner control points of the easing curve, the outer ones are (0, 0) and (1, 1)
+BEIZER_P1 = (.5, 0)
+BEIZER_P2 = (.5, 1)
 
 # pyglet.gl.glEnable(pyglet.gl.GL_LINE_SMOOTH)
 pyglet.gl.glHint(pyglet.gl.GL_LINE_SMOOTH_HINT, pyglet.gl.GL_NICEST)
 config = pyglet.gl.Config(sample_buffers=1, samples=4)  #
 window = pyglet.window.Window(vsync=1, config=config, width=SIZE, height=SIZE, visible=False, resizable=True)
+# the whole flag is one quad over the window, the fragment shader picks each pixel's stripe by its height
+STRIPE_VERTEX_SOURCE = """#version 150 core
+    in vec2 position;
+    out float flag_y;
+
+    void main()
+    {
+        gl_Position = vec4(position * 2.0 - 1.0, 0.0, 1.0);
+        flag_y = position.y;
+    }
+"""
+STRIPE_FRAGMENT_SOURCE = """#version 150 core
+    in float flag_y;
+    out vec4 final_color;
+
+    uniform int num_stripes;
+    uniform vec3 stripe_colors[%(max_stripes)d];
+    uniform float stripe_tops[%(max_stripes)d];
+
+    void main()
+    {
+        int i = 0;
+        while (i < num_stripes - 1 && flag_y >= stripe_tops[i]) {
+            i++;
+        }
+        final_color = vec4(stripe_colors[i] / 255.0, 1.0);
+    }
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def parse_hex(color: str) -> Tuple[int, int, int]:
+    # 6 digit hex with or without the #
+    value = int(color.lstrip("#"), 16)
+    return value >> 16, (value >> 8) & 0xff, value & 0xff
+
+
+@functools.lru_cache(maxsize=None)
+def split_counts(num_of_stripes: int, new_num_of_stripes: int) -> Tuple[int, ...]:
+    # how many pieces each stripe gets cut into, only depends on the stripe counts
+    split_by = math.ceil(new_num_of_stripes / num_of_stripes)
+    new_stripes_to_add = new_num_of_stripes - num_of_stripes
+    counts = []
+    for _ in range(num_of_stripes):
+        if new_stripes_to_add >= split_by:
+            counts.append(split_by)
+            new_stripes_to_add -= split_by - 1
+        elif new_stripes_to_add > 0:
+            counts.append(new_stripes_to_add + 1)
+            new_stripes_to_add = 0
+        else:
+            counts.append(1)
+    return tuple(counts)
 
 
 class FlagStripe:
@@ -49,29 +109,58 @@ class FlagImage:
     def __init__(self, im: typing.Union[pyglet.sprite.Sprite, str], x: float = 0.5, y: float = 0.5, opacity: float = 1,
                  scale: float = 1, f_type: typing.Literal["center", "left", "static"] = "center"):
         self.name = "Unknown"
+        # this one sprite gets moved around and drawn every frame rather than making a new one each time
         if isinstance(im, pyglet.sprite.Sprite):
             self.sprite = im
         else:
             self.name = im
             pic = pyglet.image.load(im)
             self.sprite = pyglet.sprite.Sprite(pic)
-        self.x = x
-        self.y = y
+        # 0-1 position on the flag, x as real and y as imaginary
+        self.pos: complex = complex(x, y)
         self.opacity = opacity
         self.scale = scale
         self.type = f_type
+        self._last_window_size: typing.Optional[Tuple[int, int]] = None
 
     def __str__(self):
         return f"<FlagImage name={self.name} type={self.type}>"
 
-    def prep_draw(self, batch: typing.Optional[pyglet.graphics.Batch] = None,
-                  group: typing.Optional[pyglet.graphics.Group] = None):
-        im2 = pyglet.sprite.Sprite(self.sprite.image, batch=batch, group=group)
-        im2.opacity = self.opacity
-        im2.scale = (window.height / self.sprite.height) * self.scale
-        im2.x = ((window.width - im2.width) // 2) + ((self.x - 0.5) * window.width)
-        im2.y = ((self.y - 0.5) * window.height)
-        return im2
+    def prep_draw(self) -> pyglet.sprite.Sprite:
+        window_size = window.get_size()
+        if window_size != self._last_window_size:
+            self._last_window_size = window_size
+            self.sprite.scale = (window.height / self.sprite.image.height) * self.scale
+        self.sprite.opacity = self.opacity
+        offset = self.pos - (0.5 + 0.5j)
+        self.sprite.x = ((window.width - self.sprite.width) // 2) + (offset.real * window.width)
+        self.sprite.y = offset.imag * window.height
+        return self.sprite
+
+
+@dataclasses.dataclass
+class FlagView:
+    """
+    just the parts of a flag that drawing needs, so transitions don't have to build a whole Flag every frame
+
+    :param stripes: N x 5 floats, each row is a stripe's R, G, B, size (0-1 % of height) and bottom (0-1 height).
+        all packed in one array so a transition is a single lerp
+    :param images: images to draw on top of the stripes
+    """
+    stripes: np.ndarray
+    images: List[FlagImage]
+
+    @property
+    def colors(self) -> np.ndarray:
+        return self.stripes[:, :3]
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return self.stripes[:, 3]
+
+    @property
+    def bottoms(self) -> np.ndarray:
+        return self.stripes[:, 4]
 
 
 class Flag:
@@ -86,15 +175,14 @@ class Flag:
                  reverse=False,
                  allow_stripes_to_combine=True):
         self.stripes: List[FlagStripe] = []
+        default_size = 1 / len(stripes)
         for s in stripes:
             if isinstance(s, FlagStripe):
                 self.stripes.append(s)
             elif isinstance(s, tuple):
-                self.stripes.append(FlagStripe(s, 1 / len(stripes)))
+                self.stripes.append(FlagStripe(s, default_size))
             elif isinstance(s, str):
-                if not s.startswith("#"):
-                    s = "#" + s
-                self.stripes.append(FlagStripe(webcolors.hex_to_rgb(s), 1 / len(stripes)))
+                self.stripes.append(FlagStripe(parse_hex(s), default_size))
             else:
                 raise Exception(f"Stripe {s} is invalid")
         if allow_stripes_to_combine:
@@ -114,42 +202,27 @@ class Flag:
             else:
                 self.images.append(FlagImage(im))
         self.name: str = name
-
-    def draw(self):
-        background = pyglet.graphics.Group(order=0)
-        foreground = pyglet.graphics.Group(order=1)
-        batch = pyglet.graphics.Batch()
-        shapes = []
-        current_height = 0
-        for fs in self.stripes:
-            shapes.append(pyglet.shapes.Rectangle(0, current_height, window.width, window.height * fs.size,
-                                                  color=(int(fs.color[0]), int(fs.color[1]), int(fs.color[2])),
-                                                  batch=batch, group=background))
-            current_height += window.height * fs.size
-        sprites = []
-        for im in self.images:
-            sprites.append(im.prep_draw(batch, foreground))
-        # print(self.images)
-        batch.draw()
-        # batch.invalidate()
+        # numpy copy of the stripes so transitions are whole-array math, see FlagView for the layout
+        self._stripe_data: np.ndarray = np.empty((len(self.stripes), 5), dtype=np.float32)
+        self._stripe_data[:, :3] = [stripe.color for stripe in self.stripes]
+        self._stripe_data[:, 3] = [stripe.size for stripe in self.stripes]
+        self._stripe_data[:, 4] = np.cumsum(self._stripe_data[:, 3]) - self._stripe_data[:, 3]
+        # stripe sizes never change after this, so neither does the midpoint
+        self._midpoint_index, self._midpoint_frac = self._compute_midpoint()
+        self.view = FlagView(self._stripe_data, self.images)
 
     def split(self, num_of_stripes: int):
         assert num_of_stripes > len(self.stripes)
-        split_by = math.ceil(num_of_stripes / len(self.stripes))
-        new_stripes_to_add = num_of_stripes - len(self.stripes)
-        output = []
-        for stripe in self.stripes:
-            if new_stripes_to_add >= split_by:
-                output += stripe.split(split_by)
-                new_stripes_to_add -= split_by - 1
-            elif new_stripes_to_add > 0:
-                output += stripe.split(new_stripes_to_add + 1)
-                new_stripes_to_add = 0
-            else:
-                output.append(stripe)
+        counts = np.array(split_counts(len(self.stripes), num_of_stripes))
+        indices = np.repeat(np.arange(len(self.stripes)), counts)
+        sizes = np.repeat(self._stripe_data[:, 3] / counts, counts)
+        output = [FlagStripe(self.stripes[i].color, size) for i, size in zip(indices.tolist(), sizes.tolist())]
         return Flag(output, images=self.images, name=self.name, allow_stripes_to_combine=False)
 
     def midpoint(self):
+        return self._midpoint_index, self._midpoint_frac
+
+    def _compute_midpoint(self):
         rolling_sum = 0
         numstripes = 0
         final_stripe_size = 0
@@ -165,55 +238,150 @@ class Flag:
         return numstripes, (.5 - rolling_sum) / final_stripe_size
 
 
+def draw(flag: FlagView):
+    # one draw call for all the stripes, only their colors and heights get uploaded each frame
+    num_stripes = len(flag.sizes)
+    stripe_colors[:num_stripes] = flag.colors
+    np.add(flag.bottoms, flag.sizes, out=stripe_tops[:num_stripes])
+    stripe_program.use()
+    pyglet.gl.glUniform1i(stripe_uniforms["num_stripes"], num_stripes)
+    pyglet.gl.glUniform3fv(stripe_uniforms["stripe_colors"], num_stripes,
+                           stripe_colors.ctypes.data_as(ctypes.POINTER(pyglet.gl.GLfloat)))
+    pyglet.gl.glUniform1fv(stripe_uniforms["stripe_tops"], num_stripes,
+                           stripe_tops.ctypes.data_as(ctypes.POINTER(pyglet.gl.GLfloat)))
+    stripe_vlist.draw(pyglet.gl.GL_TRIANGLES)
+    stripe_program.stop()
+    # at most 2 images are up at once, so just draw their sprites directly on top
+    for im in flag.images:
+        im.prep_draw().draw()
+
+
+def split_flag(flag: Flag, num_of_stripes: int) -> Flag:
+    # the same pairs of flags get split against each other every frame, so only do it once
+    key = (id(flag), num_of_stripes)
+    if key not in split_cache:
+        split_cache[key] = flag.split(num_of_stripes)
+    return split_cache[key]
+
+
+def beizer_coefficients(p1: float, p2: float) -> Tuple[float, float, float]:
+    # 1d cubic beizer from 0 to 1 as a*t^3 + b*t^2 + c*t
+    c = 3 * p1
+    b = 3 * (p2 - p1) - c
+    a = 1 - c - b
+    return a, b, c
+
+
+def beizer_ease(percent: float) -> float:
+    ax, bx, cx = beizer_x
+    ay, by, cy = beizer_y
+    # the curve is parametric, so newton's method for the t where x(t) = percent, then y(t)
+    t = percent
+    for _ in range(8):
+        x = ((ax * t + bx) * t + cx) * t - percent
+        if abs(x) < 1e-7:
+            break
+        t -= x / ((3 * ax * t + 2 * bx) * t + cx)
+    return ((ay * t + by) * t + cy) * t
+
+
+def linear_ease(percent: float) -> float:
+    return percent
+
+
 def transition(start: float, end: float, percent: float) -> float:
-    percent = max(min(percent, 1), 0)
-    # beizerify
-    if beizer:
-        percent = beizerexpr.subs(sympy.Symbol("x"), percent)
-    # linear
-    return start * (1 - percent) + end * percent
-
-
-def transition_flags(flag1: Flag, flag2: Flag, percent: float) -> Flag:
-    outflag = []
-    for i, stripe1 in enumerate(flag1.stripes):
-        stripe2 = flag2.stripes[i]
-        newcolors = (
-            transition(stripe1.color[0], stripe2.color[0], percent),
-            transition(stripe1.color[1], stripe2.color[1], percent),
-            transition(stripe1.color[2], stripe2.color[2], percent)
-        )
-        newsize = transition(stripe1.size, stripe2.size, percent)
-        outflag.append(FlagStripe(newcolors, newsize))
+    percent = ease(min(1.0, max(0.0, percent)))
+    return start + (end - start) * percent
+
+
+def transition_flags(flag1: Flag, flag2: Flag, percent: float) -> FlagView:
+    eased = ease(min(1.0, max(0.0, percent)))
+    # colors, sizes and bottoms (a cumsum of sizes, so it lerps the same way) all in one go,
+    # written into the same buffer and view every frame instead of allocating new ones
+    stripes = transition_buffer[:len(flag1)]
+    np.subtract(flag2._stripe_data, flag1._stripe_data, out=stripes)
+    stripes *= eased
+    stripes += flag1._stripe_data
+    view = transition_view
+    view.stripes = stripes
+    view.images.clear()
+    sizes = view.sizes
+    bottoms = view.bottoms
     index_of_midpoint_2, height_of_midpoint_in_stripe_2 = flag2.midpoint()
-    height_of_midpoint_2 = sum([stripe.size for stripe in outflag[:index_of_midpoint_2]]) + \
-                           outflag[index_of_midpoint_2].size * height_of_midpoint_in_stripe_2
+    height_of_midpoint_2 = bottoms[index_of_midpoint_2] + sizes[index_of_midpoint_2] * height_of_midpoint_in_stripe_2
     index_of_midpoint_1, height_of_midpoint_in_stripe_1 = flag1.midpoint()
-    height_of_midpoint_1 = sum([stripe.size for stripe in outflag[:index_of_midpoint_1]]) + \
-                           outflag[index_of_midpoint_1].size * height_of_midpoint_in_stripe_1
-    images = []
+    height_of_midpoint_1 = bottoms[index_of_midpoint_1] + sizes[index_of_midpoint_1] * height_of_midpoint_in_stripe_1
+    images = view.images
     if flag1.images:
         for image in flag1.images:
             image.opacity = int(255 * (1 - percent))
             if image.type == "center":
-                image.y = height_of_midpoint_1
+                image.pos = complex(image.pos.real, height_of_midpoint_1)
             elif image.type == "left":
-                image.x = transition(0.5, 0, percent)
+                image.pos = complex(transition(0.5, 0, percent), image.pos.imag)
             images.append(image)
     if flag2.images:
         for image in flag2.images:
             image.opacity = int(255 * percent)
             if image.type == "center":
-                image.y = height_of_midpoint_2
+                image.pos = complex(image.pos.real, height_of_midpoint_2)
             elif image.type == "left":
-                image.x = transition(0, 0.5, percent)
+                image.pos = complex(transition(0, 0.5, percent), image.pos.imag)
             images.append(image)
-    return Flag(outflag, images=images, name=f"{flag1.name}->{flag2.name} {round(percent * 100)}%")
+    return view
+
+
+def write_png(data: bytes, width: int, height: int, filename: str):
+    # gl rows go bottom to top
+    PIL.Image.frombytes("RGBA", (width, height), data).transpose(PIL.Image.Transpose.FLIP_TOP_BOTTOM).save(filename)
+
+
+class FrameRecorder:
+    """
+    reads frames back through 2 alternating pixel buffer objects, so frame N is copied off the gpu while frame N+1
+    renders, and encodes the pngs on a pool of threads instead of the main thread
+    """
+
+    def __init__(self):
+        self.pbos = (pyglet.gl.GLuint * 2)()
+        pyglet.gl.glGenBuffers(2, self.pbos)
+        # (pbo index, width, height, filename) of the frame waiting in a pbo
+        self.pending: typing.Optional[Tuple[int, int, int, str]] = None
+        # pillow lets go of the gil while it compresses, so threads are enough to encode on every core
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+
+    def capture(self, filename: str):
+        width, height = window.get_framebuffer_size()
+        index = 0 if self.pending is None else 1 - self.pending[0]
+        pyglet.gl.glBindBuffer(pyglet.gl.GL_PIXEL_PACK_BUFFER, self.pbos[index])
+        pyglet.gl.glBufferData(pyglet.gl.GL_PIXEL_PACK_BUFFER, width * height * 4, None, pyglet.gl.GL_STREAM_READ)
+        # with a pack buffer bound this returns immediately and the copy happens in the background
+        pyglet.gl.glReadPixels(0, 0, width, height, pyglet.gl.GL_RGBA, pyglet.gl.GL_UNSIGNED_BYTE, None)
+        pyglet.gl.glBindBuffer(pyglet.gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.flush()
+        self.pending = (index, width, height, filename)
+
+    def flush(self):
+        if self.pending is None:
+            return
+        index, width, height, filename = self.pending
+        self.pending = None
+        pyglet.gl.glBindBuffer(pyglet.gl.GL_PIXEL_PACK_BUFFER, self.pbos[index])
+        pointer = pyglet.gl.glMapBuffer(pyglet.gl.GL_PIXEL_PACK_BUFFER, pyglet.gl.GL_READ_ONLY)
+        data = ctypes.string_at(pointer, width * height * 4)
+        pyglet.gl.glUnmapBuffer(pyglet.gl.GL_PIXEL_PACK_BUFFER)
+        pyglet.gl.glBindBuffer(pyglet.gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.executor.submit(write_png, data, width, height, filename)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
 
 
 def update(frame_delta):
     global current_time
     global draw_flag
+    global last_transition_step
     current_index = math.floor(current_time / time_to_transition)
     next_index = current_index + 1
     while current_index >= len(flags):
@@ -226,11 +394,15 @@ def update(frame_delta):
     current_flag = flags[current_index]
     next_flag = flags[next_index]
     percent_between_flags = current_time / time_to_transition % 1
-    if len(current_flag) > len(next_flag):
-        next_flag = next_flag.split(len(current_flag))
-    elif len(current_flag) < len(next_flag):
-        current_flag = current_flag.split(len(next_flag))
-    draw_flag = transition_flags(current_flag, next_flag, percent_between_flags)
+    step = int(percent_between_flags * TRANSITION_STEPS)
+    # draw_flag already holds this step's transition, no need to work it out again
+    if (current_index, step) != last_transition_step:
+        last_transition_step = (current_index, step)
+        if len(current_flag) > len(next_flag):
+            next_flag = split_flag(next_flag, len(current_flag))
+        elif len(current_flag) < len(next_flag):
+            current_flag = split_flag(current_flag, len(next_flag))
+        draw_flag = transition_flags(current_flag, next_flag, step / TRANSITION_STEPS)
     if render:
         current_time += 1.0 / RENDER_FPS
     else:
@@ -242,23 +414,19 @@ def on_draw():
     global frame
     global draw_flag
     # window.clear()
-    draw_flag.draw()
+    draw(draw_flag)
     if render:
-        pyglet.image.get_buffer_manager().get_color_buffer().save(f"render/frame{frame}.png")
+        recorder.capture(f"render/frame{frame}.png")
         print(f"saving render/frame{frame}.png")
     frame += 1
 
 
 beizer = True
 render = True
-if beizer:
-    nodes1 = np.asfortranarray([
-        [0, .5, .5, 1],
-        [0, 0, 1, 1],
-    ])
-    curve1 = bezier.Curve.from_nodes(nodes1)
-    beizerexpr = curve1.implicitize()
-    beizerexpr = sympy.solve(beizerexpr, sympy.Symbol("y"))[0]
+beizer_x = beizer_coefficients(BEIZER_P1[0], BEIZER_P2[0])
+beizer_y = beizer_coefficients(BEIZER_P1[1], BEIZER_P2[1])
+# picked once here so transitions don't check the beizer flag every call
+ease = beizer_ease if beizer else linear_ease
 flags = [
     Flag(["#e40303", "#ff8c00", "#ffed00", "008026", "004dff", "750787"], name="gay", reverse=True),  # gay
     Flag(["55cdfc", "f7a8b8", "ffffff", "f7a8b8", "55cdfc"], name="trans", reverse=True),  # trans
@@ -287,15 +455,39 @@ het_flags = [
     Flag(["ea4c79", "423f40", "0098c3"], name="truscum", images=["truscum.png"], reverse=True),
     Flag(["db0170", "0705a4"], name="cis", reverse=True),
 ]
+split_cache: Dict[Tuple[int, int], Flag] = {}
+for flag, next_flag in zip(flags, flags[1:] + flags[:1]):
+    if len(flag) > len(next_flag):
+        split_flag(next_flag, len(flag))
+    elif len(flag) < len(next_flag):
+        split_flag(flag, len(next_flag))
+
+MAX_STRIPES = max(len(f) for f in flags + het_flags)
+stripe_program = pyglet.graphics.shader.ShaderProgram(
+    pyglet.graphics.shader.Shader(STRIPE_VERTEX_SOURCE, "vertex"),
+    pyglet.graphics.shader.Shader(STRIPE_FRAGMENT_SOURCE % {"max_stripes": MAX_STRIPES}, "fragment"),
+)
+stripe_uniforms = {name: pyglet.gl.glGetUniformLocation(stripe_program.id, name.encode())
+                   for name in ("num_stripes", "stripe_colors", "stripe_tops")}
+stripe_vlist = stripe_program.vertex_list(6, pyglet.gl.GL_TRIANGLES,
+                                          position=("f", (0, 0, 1, 0, 1, 1, 0, 0, 1, 1, 0, 1)))
+stripe_colors = np.zeros((MAX_STRIPES, 3), dtype=np.float32)
+stripe_tops = np.zeros(MAX_STRIPES, dtype=np.float32)
+transition_buffer = np.empty((MAX_STRIPES, 5), dtype=np.float32)
+transition_view = FlagView(transition_buffer, [])
 
 current_time = 0
 frame = 0
 print([str(f) for f in flags])
 time_to_transition = 1
-draw_flag = flags[0]
+draw_flag = flags[0].view
+last_transition_step: typing.Optional[Tuple[int, int]] = None
 if render and not os.path.isdir("render"):
     os.mkdir("render")
+recorder = FrameRecorder() if render else None
 # pyglet.gl.glEnable(pyglet.gl.GL_BLEND)
 window.set_visible()
 pyglet.clock.schedule(update)
 pyglet.app.run()
+if recorder:
+    recorder.close()